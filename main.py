@@ -1,7 +1,7 @@
-from fastapi import FastAPI, HTTPException, Depends
+from fastapi import FastAPI, HTTPException, Depends, Header, Query
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, PlainTextResponse
 from pydantic import BaseModel, Field
 from typing import List, Optional, Dict, Any
 import httpx
@@ -10,6 +10,16 @@ from datetime import datetime, date
 from enum import Enum
 import logging
 import os
+import math
+import sys
+import asyncio
+import secrets
+import threading
+import time
+import traceback
+from collections import Counter, deque
+from contextlib import asynccontextmanager, suppress
+from contextvars import ContextVar
 from functools import lru_cache
 from dotenv import load_dotenv
 
@@ -20,10 +30,260 @@ load_dotenv()
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Profiling configuration
+def _env_number(name: str, default, parse, minimum):
+    """Read a numeric setting, falling back to the default when it is missing or invalid"""
+    raw = os.getenv(name)
+    if raw is None or raw.strip() == "":
+        return default
+    try:
+        value = parse(raw)
+    except ValueError:
+        value = None
+    if value is None or not math.isfinite(value) or value < minimum:
+        logger.warning(f"Ignoring invalid {name}={raw!r}, using default {default}")
+        return default
+    return value
+
+@lru_cache()
+def get_profiling_settings():
+    return {
+        "admin_token": os.getenv("ADMIN_TOKEN", ""),
+        "slow_request_threshold_ms": _env_number("SLOW_REQUEST_THRESHOLD_MS", 1000.0, float, 0),
+        "slow_request_buffer_size": _env_number("SLOW_REQUEST_BUFFER_SIZE", 50, int, 1),
+        "loop_stall_threshold_ms": _env_number("LOOP_STALL_THRESHOLD_MS", 200.0, float, 0)
+    }
+
+# Profiling and request timing
+_request_stages: ContextVar[Optional[Dict[str, float]]] = ContextVar("request_stages", default=None)
+
+def record_stage(name: str, started: float):
+    """Add the time since `started` (a perf_counter value) to a stage of the current request"""
+    stages = _request_stages.get()
+    if stages is not None:
+        stages[name] = stages.get(name, 0.0) + (time.perf_counter() - started) * 1000
+
+class SlowRequestLog:
+    """Ring buffer of recent requests that exceeded the slow request threshold"""
+
+    def __init__(self, threshold_ms: float, size: int):
+        self.threshold_ms = threshold_ms
+        self.entries = deque(maxlen=size)
+
+    def record(self, method: str, path: str, status_code: int, duration_ms: float, stages: Dict[str, float]):
+        if duration_ms < self.threshold_ms:
+            return
+        breakdown = {name: round(ms, 2) for name, ms in stages.items()}
+        breakdown["unattributed"] = round(max(duration_ms - sum(stages.values()), 0.0), 2)
+        self.entries.append({
+            "method": method,
+            "path": path,
+            "status_code": status_code,
+            "duration_ms": round(duration_ms, 2),
+            "stages_ms": breakdown,
+            "timestamp": datetime.now().isoformat()
+        })
+
+    def slowest(self, limit: int) -> List[Dict[str, Any]]:
+        return sorted(self.entries, key=lambda entry: entry["duration_ms"], reverse=True)[:limit]
+
+class RequestTimingMiddleware:
+    """ASGI middleware that times each request up to its last body chunk"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"].startswith("/admin"):
+            await self.app(scope, receive, send)
+            return
+
+        stages: Dict[str, float] = {}
+        token = _request_stages.set(stages)
+        started = time.perf_counter()
+        finished: Optional[float] = None
+        status_code = 500
+
+        async def timed_send(message):
+            nonlocal finished, status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+            if message["type"] == "http.response.body" and not message.get("more_body", False):
+                finished = time.perf_counter()
+
+        try:
+            await self.app(scope, receive, timed_send)
+        finally:
+            duration_ms = ((finished or time.perf_counter()) - started) * 1000
+            _request_stages.reset(token)
+            slow_requests.record(scope["method"], scope["path"], status_code, duration_ms, stages)
+
+def _collapse_stack(frame) -> str:
+    """Render a frame and its callers as a root-first, semicolon-separated stack"""
+    labels = []
+    while frame is not None:
+        code = frame.f_code
+        labels.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+        frame = frame.f_back
+    return ";".join(reversed(labels))
+
+class SamplingProfiler:
+    """Samples the event loop thread's stack from a helper thread"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+
+    def run(self, thread_id: int, duration: float, interval: float) -> str:
+        """Sample for `duration` seconds and return stacks in flamegraph collapsed format"""
+        if not self._lock.acquire(blocking=False):
+            raise RuntimeError("A profiling session is already running")
+        try:
+            counts = Counter()
+            deadline = time.monotonic() + duration
+            while time.monotonic() < deadline:
+                frame = sys._current_frames().get(thread_id)
+                if frame is not None:
+                    counts[_collapse_stack(frame)] += 1
+                del frame
+                time.sleep(interval)
+        finally:
+            self._lock.release()
+        return "".join(f"{stack} {count}\n" for stack, count in counts.most_common())
+
+class LoopStallDetector:
+    """Logs the event loop stack whenever its heartbeat falls behind the stall threshold"""
+
+    def __init__(self, threshold_ms: float, max_logged_stacks: int = 5, log_window: float = 60.0):
+        self.threshold = threshold_ms / 1000
+        self.interval = max(self.threshold / 4, 0.01)
+        self.thread_id: Optional[int] = None
+        self.stall_count = 0
+        self.recent_stalls = deque(maxlen=20)
+        self.max_logged_stacks = max_logged_stacks
+        self.log_window = log_window
+        self._window_start = time.monotonic()
+        self._window_logged = 0
+        self._window_suppressed = 0
+        self._last_beat = time.monotonic()
+        self._stop: Optional[threading.Event] = None
+        self._thread: Optional[threading.Thread] = None
+
+    async def heartbeat(self):
+        while True:
+            self._last_beat = time.monotonic()
+            await asyncio.sleep(self.interval)
+
+    def start(self, thread_id: int):
+        self.stop()
+        self.thread_id = thread_id
+        self._last_beat = time.monotonic()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(
+            target=self._watch, args=(self._stop,), name="loop-stall-detector", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        if self._stop is not None:
+            self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=1.0)
+        self._stop = None
+        self._thread = None
+
+    def _should_log(self) -> bool:
+        """Allow at most `max_logged_stacks` stall reports per `log_window` seconds"""
+        now = time.monotonic()
+        if now - self._window_start >= self.log_window:
+            if self._window_suppressed:
+                logger.warning(
+                    f"Suppressed {self._window_suppressed} event loop stall reports in the last {self.log_window:.0f}s"
+                )
+            self._window_start = now
+            self._window_logged = 0
+            self._window_suppressed = 0
+        if self._window_logged < self.max_logged_stacks:
+            self._window_logged += 1
+            return True
+        self._window_suppressed += 1
+        return False
+
+    def _watch(self, stop: threading.Event):
+        reported_beat = None
+        stall = None
+        stall_logged = False
+        while not stop.wait(self.interval):
+            last_beat = self._last_beat
+            if stall is not None and last_beat != reported_beat:
+                # The loop is running again; the heartbeat gap is the real stall length
+                blocked_ms = (last_beat - reported_beat - self.interval) * 1000
+                stall["blocked_ms"] = round(blocked_ms, 2)
+                stall["in_progress"] = False
+                if stall_logged:
+                    logger.warning(f"Event loop recovered after being blocked for {blocked_ms:.0f}ms")
+                stall = None
+
+            lag = time.monotonic() - last_beat - self.interval
+            if lag < self.threshold or last_beat == reported_beat:
+                continue
+            # Capture the stack the loop is stuck in now; the duration is filled in once it recovers
+            reported_beat = last_beat
+            frame = sys._current_frames().get(self.thread_id)
+            stack = "".join(traceback.format_stack(frame)) if frame is not None else ""
+            del frame
+            self.stall_count += 1
+            stall = {
+                "blocked_ms": round(lag * 1000, 2),
+                "in_progress": True,
+                "stack": stack,
+                "timestamp": datetime.now().isoformat()
+            }
+            self.recent_stalls.append(stall)
+            # Log now as well, since the loop may never recover to report the duration
+            stall_logged = self._should_log()
+            if stall_logged:
+                logger.warning(f"Event loop blocked for over {lag * 1000:.0f}ms, current stack:\n{stack}")
+
+_profiling_settings = get_profiling_settings()
+slow_requests = SlowRequestLog(
+    threshold_ms=_profiling_settings["slow_request_threshold_ms"],
+    size=_profiling_settings["slow_request_buffer_size"]
+)
+sampling_profiler = SamplingProfiler()
+stall_detector = (
+    LoopStallDetector(_profiling_settings["loop_stall_threshold_ms"])
+    if _profiling_settings["loop_stall_threshold_ms"] > 0 else None
+)
+
+# Thread running the event loop, sampled by the admin profiling routes
+_loop_thread_id: Optional[int] = None
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Run the event loop profiling helpers for the lifetime of the server"""
+    global _loop_thread_id
+    _loop_thread_id = threading.get_ident()
+    heartbeat_task = None
+    if stall_detector is not None:
+        stall_detector.start(_loop_thread_id)
+        heartbeat_task = asyncio.create_task(stall_detector.heartbeat())
+    try:
+        yield
+    finally:
+        if heartbeat_task is not None:
+            heartbeat_task.cancel()
+            with suppress(asyncio.CancelledError):
+                await heartbeat_task
+        if stall_detector is not None:
+            stall_detector.stop()
+        _loop_thread_id = None
+
 app = FastAPI(
     title="Dubai Police Crime Research API",
     description="Crime research and analysis system for Dubai Police using Perplexity AI",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
 
 # CORS middleware
@@ -35,6 +295,9 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Per-request timing for the slow request log
+app.add_middleware(RequestTimingMiddleware)
+
 # Mount static files
 app.mount("/static", StaticFiles(directory="."), name="static")
 
@@ -143,6 +406,13 @@ def get_settings():
         "perplexity_base_url": "https://api.perplexity.ai/chat/completions"
     }
 
+def require_admin(x_admin_token: Optional[str] = Header(None)):
+    expected = get_profiling_settings()["admin_token"]
+    if not expected:
+        raise HTTPException(status_code=403, detail="Admin endpoints are disabled; set ADMIN_TOKEN to enable them")
+    if not secrets.compare_digest((x_admin_token or "").encode(), expected.encode()):
+        raise HTTPException(status_code=401, detail="Invalid admin token")
+
 class PerplexityClient:
     def __init__(self, api_key: str, base_url: str):
         self.api_key = api_key
@@ -154,7 +424,8 @@ class PerplexityClient:
 
     async def search_crimes(self, search_request: SearchRequest) -> Dict[str, Any]:
         """Search for crime data using Perplexity AI"""
-        
+        stage_start = time.perf_counter()
+
         # Construct the specialized prompt
         prompt = self._build_crime_search_prompt(search_request)
         
@@ -173,8 +444,13 @@ class PerplexityClient:
             "temperature": 0.1,
             "max_tokens": 4000
         }
+        record_stage("prompt_build", stage_start)
 
+        setup_start = time.perf_counter()
         async with httpx.AsyncClient() as client:
+            record_stage("client_setup", setup_start)
+            upstream_start = time.perf_counter()
+            parse_start = None
             try:
                 response = await client.post(
                     self.base_url,
@@ -182,14 +458,22 @@ class PerplexityClient:
                     json=payload,
                     timeout=60.0
                 )
+                record_stage("upstream", upstream_start)
+                parse_start = time.perf_counter()
                 response.raise_for_status()
                 return response.json()
             except httpx.HTTPError as e:
                 logger.error(f"Perplexity API error: {e}")
                 raise HTTPException(status_code=500, detail=f"External API error: {str(e)}")
+            finally:
+                if parse_start is None:
+                    record_stage("upstream", upstream_start)
+                else:
+                    record_stage("parse", parse_start)
 
     async def chat_query(self, message: str, context: Optional[Dict] = None) -> Dict[str, Any]:
         """Handle general chat queries about crime research"""
+        stage_start = time.perf_counter()
 
         # Check if this is a crime/incident query that should search the database first
         crime_keywords = ["terrorist", "terrorism", "attack", "incident", "bombing", "shooting", "crime", "fraud", "murder", "theft", "robbery"]
@@ -221,8 +505,10 @@ class PerplexityClient:
                     max_results=10
                 )
 
-                # Search the crime database
+                # Search the crime database (timed under its own stages)
+                record_stage("prompt_build", stage_start)
                 search_result = await self.search_crimes(search_req)
+                stage_start = time.perf_counter()
 
                 # Extract crime data if found
                 if search_result.get("cases"):
@@ -242,6 +528,7 @@ class PerplexityClient:
 
             except Exception as e:
                 logger.error(f"Error searching crime database: {str(e)}")
+                stage_start = time.perf_counter()
 
         # Enhanced system prompt for better UI formatting
         system_prompt = """You are a specialized Dubai Police Crime Research Assistant. When providing information about crimes or incidents, follow these formatting guidelines:
@@ -340,8 +627,13 @@ IMPORTANT:
             "model": "sonar",
             "messages": messages
         }
+        record_stage("prompt_build", stage_start)
 
+        setup_start = time.perf_counter()
         async with httpx.AsyncClient() as client:
+            record_stage("client_setup", setup_start)
+            upstream_start = time.perf_counter()
+            parse_start = None
             try:
                 logger.info(f"Sending simplified payload to Perplexity")
                 response = await client.post(
@@ -377,6 +669,8 @@ IMPORTANT:
                             }]
                         }
 
+                record_stage("upstream", upstream_start)
+                parse_start = time.perf_counter()
                 response.raise_for_status()
                 return response.json()
 
@@ -399,6 +693,11 @@ IMPORTANT:
                     }]
                 }
                 return fallback_response
+            finally:
+                if parse_start is None:
+                    record_stage("upstream", upstream_start)
+                else:
+                    record_stage("parse", parse_start)
 
     def _build_crime_search_prompt(self, search_request: SearchRequest) -> str:
         """Build the specialized crime search prompt"""
@@ -523,6 +822,7 @@ async def search_crimes(
         response = await perplexity_client.search_crimes(search_request)
 
         # Extract and parse the JSON response
+        parse_start = time.perf_counter()
         content = response.get("choices", [{}])[0].get("message", {}).get("content", "")
 
         try:
@@ -566,6 +866,8 @@ async def search_crimes(
             logger.error(f"Failed to parse JSON response: {str(e)}")
             logger.error(f"Content was: {content[:500]}...")
             return []
+        finally:
+            record_stage("parse", parse_start)
 
     except Exception as e:
         logger.error(f"Error searching crimes: {str(e)}")
@@ -585,13 +887,16 @@ async def chat_with_assistant(
             chat_message.context
         )
         
+        parse_start = time.perf_counter()
         content = response.get("choices", [{}])[0].get("message", {}).get("content", "")
         
-        return ChatResponse(
+        chat_response = ChatResponse(
             response=content,
             crime_data=None,
             sources=None
         )
+        record_stage("parse", parse_start)
+        return chat_response
         
     except Exception as e:
         logger.error(f"Error in chat: {str(e)}")
@@ -669,6 +974,48 @@ Return confidence score (1-10) for each data point and overall assessment."""
         logger.error(f"Error verifying case: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
+# Admin profiling routes
+@app.post("/admin/profile", response_class=PlainTextResponse, dependencies=[Depends(require_admin)])
+async def profile_event_loop(
+    seconds: float = Query(default=10, ge=1, le=60, description="How long to sample for"),
+    interval_ms: float = Query(default=10, ge=1, le=1000, description="Time between samples")
+):
+    """Sample the event loop for a while and return a flamegraph-compatible collapsed stack file"""
+    if _loop_thread_id is None:
+        raise HTTPException(status_code=503, detail="Event loop thread is not known yet; the server has not finished starting")
+    try:
+        collapsed = await asyncio.to_thread(
+            sampling_profiler.run, _loop_thread_id, seconds, interval_ms / 1000
+        )
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+
+    filename = f"profile-{datetime.now().strftime('%Y%m%d-%H%M%S')}.collapsed"
+    return PlainTextResponse(
+        collapsed,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
+
+@app.get("/admin/slow-requests", dependencies=[Depends(require_admin)])
+async def get_slow_requests(limit: int = Query(default=20, ge=1, le=500)):
+    """List the slowest recently captured requests with their per-stage timings"""
+    return {
+        "threshold_ms": slow_requests.threshold_ms,
+        "requests": slow_requests.slowest(limit)
+    }
+
+@app.get("/admin/loop-stalls", dependencies=[Depends(require_admin)])
+async def get_loop_stalls():
+    """List recent event loop stalls and the stacks they were blocked in"""
+    if stall_detector is None:
+        return {"enabled": False, "stall_count": 0, "stalls": []}
+    return {
+        "enabled": True,
+        "threshold_ms": stall_detector.threshold * 1000,
+        "stall_count": stall_detector.stall_count,
+        "stalls": list(stall_detector.recent_stalls)
+    }
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
@@ -0,0 +1,96 @@
+import asyncio
+import os
+import time
+
+# Profiling settings are read when main is imported
+os.environ["PERPLEXITY_API_KEY"] = "test-key"
+os.environ["SLOW_REQUEST_THRESHOLD_MS"] = "0"
+os.environ["LOOP_STALL_THRESHOLD_MS"] = "100"
+os.environ.pop("ADMIN_TOKEN", None)
+
+import httpx
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+
+ADMIN_TOKEN = "test-admin-token"
+
+
+@main.app.get("/test/block")
+async def block_event_loop():
+    time.sleep(0.5)
+    return {"status": "done"}
+
+
+@pytest.fixture
+def admin_token(monkeypatch):
+    monkeypatch.setenv("ADMIN_TOKEN", ADMIN_TOKEN)
+    main.get_profiling_settings.cache_clear()
+    yield {"X-Admin-Token": ADMIN_TOKEN}
+    main.get_profiling_settings.cache_clear()
+
+
+@pytest.fixture
+def client():
+    with TestClient(main.app) as test_client:
+        yield test_client
+
+
+def test_admin_endpoints_disabled_without_token(client, monkeypatch):
+    monkeypatch.delenv("ADMIN_TOKEN", raising=False)
+    main.get_profiling_settings.cache_clear()
+
+    for path in ["/admin/slow-requests", "/admin/loop-stalls"]:
+        response = client.get(path, headers={"X-Admin-Token": "anything"})
+        assert response.status_code == 403
+    assert client.post("/admin/profile").status_code == 403
+
+
+def test_admin_endpoints_reject_wrong_token(client, admin_token):
+    assert client.get("/admin/slow-requests").status_code == 401
+    assert client.get("/admin/slow-requests", headers={"X-Admin-Token": "wrong"}).status_code == 401
+    # Starlette decodes headers as latin-1, so this reaches require_admin as non-ASCII text
+    assert client.get("/admin/slow-requests", headers={"X-Admin-Token": b"\xe9"}).status_code == 401
+    assert client.get("/admin/slow-requests", headers=admin_token).status_code == 200
+
+
+def test_blocking_route_records_stall_duration(client, admin_token):
+    main.stall_detector.recent_stalls.clear()
+
+    assert client.get("/test/block").status_code == 200
+    # Give the watcher a few polls to notice the heartbeat has resumed
+    time.sleep(0.3)
+
+    response = client.get("/admin/loop-stalls", headers=admin_token)
+    assert response.status_code == 200
+    stalls = response.json()["stalls"]
+    assert stalls
+    stall = max(stalls, key=lambda entry: entry["blocked_ms"])
+    assert not stall["in_progress"]
+    assert 400 <= stall["blocked_ms"] <= 700
+    assert "block_event_loop" in stall["stack"]
+
+
+def test_chat_records_stage_timings(client, admin_token, monkeypatch):
+    async def fake_post(self, url, **kwargs):
+        await asyncio.sleep(0.2)
+        return httpx.Response(
+            200,
+            json={"choices": [{"message": {"content": "Hello from the assistant"}}]},
+            request=httpx.Request("POST", url)
+        )
+
+    monkeypatch.setattr(httpx.AsyncClient, "post", fake_post)
+    main.slow_requests.entries.clear()
+
+    response = client.post("/chat", json={"message": "Hello"})
+    assert response.status_code == 200
+    assert response.json()["response"] == "Hello from the assistant"
+
+    slow = client.get("/admin/slow-requests", headers=admin_token).json()["requests"]
+    chat = next(entry for entry in slow if entry["path"] == "/chat")
+    stages = chat["stages_ms"]
+    for stage in ["client_setup", "prompt_build", "upstream", "parse"]:
+        assert stage in stages
+    assert 200 <= stages["upstream"] < 300